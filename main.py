@@ -1,97 +1,188 @@
-import json
+import os
+import sqlite3
 import sys
+import tempfile
+import time
 
-from argparse import ArgumentParser, Namespace
+from functools import lru_cache
 from pathlib import Path
-from subprocess import check_output, CalledProcessError, STDOUT
-from typing import List, Tuple
+from shutil import which
+from subprocess import check_output, run, CalledProcessError, DEVNULL
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 PLUGIN_NAME = "checkouts_cache_plugin"
 CHECKOUTS_FILE = "checkouts.db"
-BRANCHES_FILE = "branches.db"
+BRANCHES_FILE = "branches.sqlite"
+LEGACY_BRANCHES_FILE = "branches.db"
 CHECKOUTS_LIMIT = 10
+CHECKOUTS_HISTORY_LIMIT = 100
+BRANCHES_HISTORY_LIMIT = 100
+
+_SEPARATOR = "+ --- + " + 30 * "-" + " + " + 40 * "-" + " +"
+_HEADER = f"| {'n':^3} | {'name':<30} | {'description':<40} |"
+
+
+class Arguments(NamedTuple):
+    branch: Optional[str] = None
+    b: Optional[List[str]] = None
+    n: Optional[int] = None
+    d: Optional[int] = None
+    c: Optional[List[str]] = None
+    list: bool = False
+
+
+@lru_cache(maxsize=None)
+def _git_toplevel() -> Optional[str]:
+    try:
+        output = check_output(["git", "rev-parse", "--show-toplevel"], stderr=DEVNULL)
+    except CalledProcessError:
+        return None
+    return output.decode().strip()
+
+
+def _run_git(*args: str) -> None:
+    run(["git", *args], stdout=DEVNULL, check=True)
 
 
 class Cache:
     def __init__(self) -> None:
         self._path = self._get_root_config_dir()
         self._checkouts_path = self._create_checkouts_path()
-        self._branches_path = self._create_branches_path()
+        self._branches_path = self._path / BRANCHES_FILE
+        self._connection: Optional[sqlite3.Connection] = None
+        self._checkouts: Optional[List[str]] = None
+        self._branches: Optional[Dict[str, str]] = None
 
     def _get_root_config_dir(self) -> Path:
-        root = check_output(["git", "rev-parse", "--show-toplevel"]).decode().strip()
+        root = _git_toplevel()
+        assert root is not None, "not in active git repo"
         path = Path(root) / ".git" / PLUGIN_NAME
         path.mkdir(parents=True, exist_ok=True)
         return path
 
     def _create_checkouts_path(self) -> Path:
         path = self._path / CHECKOUTS_FILE
-        path.touch()
+        if not path.exists():
+            path.touch()
         return path
 
-    def _create_branches_path(self) -> Path:
-        path = self._path / BRANCHES_FILE
-        path.touch()
-        return path
+    def _replace(self, path: Path, data: bytes) -> None:
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
 
     def _write(self, path: Path, elems: List[str]) -> None:
-        path.write_text("\n".join(elems))
+        self._replace(path, "\n".join(elems).encode())
 
     def _read(self, path: Path) -> List[str]:
-        text = path.read_text()
-        if text.strip() == "":
-            return []
-        return text.split("\n")
+        text = path.read_bytes().decode()
+        return text.split("\n") if text else []
 
     def _write_checkouts(self, checkouts: List[str]) -> None:
+        self._checkouts = checkouts
         self._write(self._checkouts_path, checkouts)
 
-    def _write_branches(self, branches: List[str]) -> None:
-        self._write(self._branches_path, branches)
-
     def _read_checkouts(self) -> List[str]:
-        return self._read(self._checkouts_path)
+        if self._checkouts is None:
+            self._checkouts = self._read(self._checkouts_path)
+        return self._checkouts
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(str(self._branches_path))
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS branches"
+                "(name TEXT PRIMARY KEY, description TEXT, ts INTEGER)"
+            )
+            legacy_path = self._path / LEGACY_BRANCHES_FILE
+            if legacy_path.exists():
+                self._migrate_legacy_branches(legacy_path)
+        return self._connection
+
+    def _migrate_legacy_branches(self, path: Path) -> None:
+        import json
+
+        branches: Dict[str, str] = {}
+        with path.open("rb") as lines:
+            for line in lines:
+                if line.strip() == b"":
+                    continue
+                # one {"name", "description"} object per line, newest first
+                obj = json.loads(line)
+                branches.setdefault(obj["name"], obj["description"])
+        now = time.time_ns()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO branches VALUES (?, ?, ?)",
+                [(b, d, now - i) for i, (b, d) in enumerate(branches.items())],
+            )
+        path.unlink()
 
-    def _read_branches(self) -> List[str]:
-        return self._read(self._branches_path)
+    def _read_branches(self) -> Dict[str, str]:
+        if self._branches is None:
+            rows = self._connect().execute(
+                "SELECT name, description FROM branches ORDER BY ts DESC"
+            )
+            self._branches = dict(rows)
+        return self._branches
 
     def add_checkout(self, branch: str) -> None:
-        checkouts = [b for b in self._read_checkouts() if b != branch]
-        checkouts.insert(0, branch)
-        self._write_checkouts(checkouts)
+        checkouts = self._read_checkouts()
+        if checkouts and checkouts[0] == branch:
+            return
+        new = list(dict.fromkeys([branch, *checkouts]))
+        self._write_checkouts(new[:CHECKOUTS_HISTORY_LIMIT])
 
     def remove_checkout(self, branch: str) -> None:
         checkouts = [b for b in self._read_checkouts() if b != branch]
         self._write_checkouts(checkouts)
 
     def add_branch(self, name: str, description: str) -> None:
-        branches = self._read_branches()
-        branches.insert(0, json.dumps({"name": name, "description": description}))
-        self._write_branches(branches)
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO branches VALUES (?, ?, ?)",
+                (name, description, time.time_ns()),
+            )
+            connection.execute(
+                "DELETE FROM branches WHERE name NOT IN "
+                "(SELECT name FROM branches ORDER BY ts DESC LIMIT ?)",
+                (BRANCHES_HISTORY_LIMIT,),
+            )
+        self._branches = None
 
     def change_description_of_branch(self, name: str, description: str) -> None:
-        branches = [
-            json.dumps({"name": b, "description": d})
-            for b, d in self.get_branches()
-            if b != name
-        ]
-        branches.insert(0, json.dumps({"name": name, "description": description}))
-        self._write_branches(branches)
+        connection = self._connect()
+        with connection:
+            cursor = connection.execute(
+                "UPDATE branches SET description = ?, ts = ? WHERE name = ?",
+                (description, time.time_ns(), name),
+            )
+        if cursor.rowcount == 0:
+            return self.add_branch(name, description)
+        self._branches = None
 
     def get_checkouts(self) -> List[str]:
         return self._read_checkouts()
 
-    def get_branches(self) -> List[Tuple[str, str]]:
-        result = []
-        for line in self._read_branches():
-            obj = json.loads(line)
-            result.append((obj["name"], obj["description"]))
-        return result
+    def snapshot(self) -> Tuple[List[str], Dict[str, str]]:
+        # returns the cached objects themselves, callers must not modify them
+        return self._read_checkouts(), self._read_branches()
+
+
+@lru_cache(maxsize=1)
+def get_cache() -> Cache:
+    return Cache()
 
 
 class CheckoutManager:
     def __init__(self) -> None:
-        self._cache = Cache()
+        self._cache = get_cache()
 
     def _get_checkout(self, n: int) -> str:
         checkouts = self._cache.get_checkouts()
@@ -101,7 +192,7 @@ class CheckoutManager:
     def _create_time_based_checkout(self, n: int) -> None:
         name = self._get_checkout(n)
         try:
-            check_output(["git", "checkout", name])
+            _run_git("checkout", name)
             self._cache.add_checkout(name)
         except CalledProcessError:
             sys.exit(1)
@@ -111,7 +202,7 @@ class CheckoutManager:
             return self._create_time_based_checkout(1)
 
         try:
-            check_output(["git", "checkout", name])
+            _run_git("checkout", name)
             self._cache.add_checkout(name)
         except CalledProcessError:
             sys.exit(1)
@@ -127,7 +218,7 @@ class CheckoutManager:
 
     def _create_branch(self, name: str, description: str) -> None:
         try:
-            check_output(["git", "checkout", "-b", name])
+            _run_git("checkout", "-b", name)
             self._cache.add_branch(name, description)
             self._cache.add_checkout(name)
         except CalledProcessError:
@@ -138,24 +229,19 @@ class CheckoutManager:
         self._cache.change_description_of_branch(name, description)
 
     def _print_checkouts(self) -> None:
-        branches = {
-            name: description for name, description in self._cache.get_branches()
-        }
-        checkouts = self._cache.get_checkouts()[0:CHECKOUTS_LIMIT]
+        checkouts, branches = self._cache.snapshot()
+        checkouts = checkouts[0:CHECKOUTS_LIMIT]
         if not checkouts:
             return
-        print("+", "---", "+", 30 * "-", "+", 40 * "-", "+")
-        print("| {:^3} | {:<30} | {:<40} |".format("n", "name", "description"))
-        print("+", "---", "+", 30 * "-", "+", 40 * "-", "+")
-        for i, checkout in enumerate(checkouts):
-            print(
-                "| {:^3} | {:<30} | {:<40} |".format(
-                    i, checkout[0:30], branches.get(checkout, "")[0:40]
-                )
-            )
-        print("+", "---", "+", 30 * "-", "+", 40 * "-", "+")
-
-    def run(self, args: Namespace) -> None:
+        table = [_SEPARATOR, _HEADER, _SEPARATOR]
+        table.extend(
+            f"| {i:^3} | {checkout[:30]:<30} | {branches.get(checkout, '')[:40]:<40} |"
+            for i, checkout in enumerate(checkouts)
+        )
+        table.append(_SEPARATOR)
+        sys.stdout.write("\n".join(table) + "\n")
+
+    def run(self, args: Arguments) -> None:
         if args.branch is not None:
             self._create_name_based_checkout(args.branch)
         elif args.b:
@@ -173,29 +259,23 @@ class CheckoutManager:
 
 
 def git_exists() -> bool:
-    try:
-        check_output(["which", "git"], stderr=STDOUT)
-    except CalledProcessError:
-        return False
-    return True
+    return which("git") is not None
 
 
 def git_repo_exists() -> bool:
-    try:
-        check_output(["git", "rev-parse", "--show-toplevel"], stderr=STDOUT)
-    except CalledProcessError:
-        return False
-    return True
+    return _git_toplevel() is not None
 
 
-def main() -> None:
-    if not git_exists():
-        print("git not found", file=sys.stderr)
-        sys.exit(1)
+def parse_args(argv: List[str]) -> Arguments:
+    # the most common invocations are handled without loading argparse
+    if len(argv) == 1 and (argv[0] == "-" or not argv[0].startswith("-")):
+        return Arguments(branch=argv[0])
+    if len(argv) == 1 and argv[0] in ("-l", "--list"):
+        return Arguments(list=True)
+    if len(argv) == 2 and argv[0] == "-n" and argv[1].isdecimal():
+        return Arguments(n=int(argv[1]))
 
-    if not git_repo_exists():
-        print("not in active git repo", file=sys.stderr)
-        sys.exit(1)
+    from argparse import ArgumentParser
 
     parser = ArgumentParser()
     group = parser.add_mutually_exclusive_group()
@@ -212,8 +292,19 @@ def main() -> None:
         help="change the description of the branch",
     )
     group.add_argument("-l", "--list", action="store_true", help="list all checkouts")
-    args = parser.parse_args()
+    return Arguments(**vars(parser.parse_args(argv)))
+
+
+def main() -> None:
+    if not git_exists():
+        print("git not found", file=sys.stderr)
+        sys.exit(1)
+
+    if not git_repo_exists():
+        print("not in active git repo", file=sys.stderr)
+        sys.exit(1)
 
+    args = parse_args(sys.argv[1:])
     CheckoutManager().run(args)
 
 